@@ -0,0 +1,353 @@
+"""Controller load benchmark for the HAP side of the bridge.
+
+Starts an AccessoryDriver on localhost with a synthetic inventory wired to
+the stub broker, and connects several HAP controllers to it at once, as Home
+hubs and phones would. Each controller pair verifies, fetches /accessories,
+subscribes to events on a share of the characteristics and then keeps
+issuing characteristic reads and writes until the duration ends, while
+sensor updates are fed through the stub broker to generate events. For each
+sensors and controllers combination the latency percentiles and throughput
+of every operation are reported and written as JSON.
+
+The controllers are added to the driver state instead of running pair
+setup, and they share the process with the driver, so the numbers include
+their own overhead.
+
+Usage:
+    python bench_controllers.py [--sensors 10 100 1000] [--controllers 1 4 16]
+        [--duration 10] [--feed-rate 100] [--output results/]
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import statistics
+import tempfile
+import threading
+import time
+
+import stubs
+import hap_controller
+
+from pyhap.accessory import Bridge
+from pyhap.accessory_driver import AccessoryDriver
+
+import bridge_setup
+
+DEFAULT_SENSORS = [10, 100, 1000]
+DEFAULT_CONTROLLERS = [1, 4, 16]
+DEFAULT_DURATION = 10.0
+DEFAULT_FEED_RATE = 100.0
+HOST = "127.0.0.1"
+
+# Mix of operations run by each controller once connected
+READ_SHARE = 0.7
+READ_BATCH = 4
+SUBSCRIBE_SHARE = 0.25
+
+NUMERIC_FORMATS = {"float", "int", "uint8", "uint16", "uint32", "uint64"}
+
+
+def freePort():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+class DriverThread(threading.Thread):
+    """Runs an AccessoryDriver with the bridge on its own event loop
+
+    The driver is built inside the thread, as it only publishes events
+    directly from the thread that created it, and `ready` is set once the
+    HAP server is listening.
+    """
+
+    def __init__(self, devices, controllers, persistDir):
+        super().__init__(name="bench-driver", daemon=True)
+        self.devices = devices
+        self.controllers = controllers
+        self.persistDir = persistDir
+        self.port = freePort()
+        self.broker = stubs.StubBroker()
+        self.driver = None
+        self.ready = threading.Event()
+        self.error = None
+
+    def run(self):
+        try:
+            self.driver = AccessoryDriver(
+                address=HOST,
+                port=self.port,
+                persist_file=os.path.join(self.persistDir, f"{self.port}.state"),
+                async_zeroconf_instance=stubs.StubAdvertiser(),
+            )
+            bridge = Bridge(self.driver, "IotCloud")
+            api = stubs.StubApi(self.devices)
+            bridge_setup.setupBridge(
+                bridge, self.driver, api, self.broker, stubs.LOCATION_ID
+            )
+            for controller in self.controllers:
+                controller.register(self.driver.state)
+            self.driver.add_accessory(bridge)
+            self.driver.loop.run_until_complete(self.driver.async_start())
+        except Exception as e:
+            self.error = e
+            return
+        finally:
+            self.ready.set()
+
+        # Until async_stop stops the loop
+        try:
+            self.driver.loop.run_forever()
+        finally:
+            self.driver.loop.close()
+
+    def stop(self):
+        self.driver.stop()
+        self.join()
+
+
+class SensorFeed(threading.Thread):
+    """Delivers the sample device messages through the stub broker at a fixed rate"""
+
+    def __init__(self, broker, messages, rate):
+        super().__init__(name="bench-feed", daemon=True)
+        self.broker = broker
+        self.messages = messages
+        self.rate = rate
+        self.stopEvent = threading.Event()
+        self.delivered = 0
+
+    def run(self):
+        if not self.messages or self.rate <= 0:
+            return
+
+        period = 1.0 / self.rate
+        nextTime = time.monotonic()
+        index = 0
+        while not self.stopEvent.is_set():
+            topic, payload = self.messages[index]
+            self.broker.deliver(topic, payload)
+            self.delivered += 1
+            index = (index + 1) % len(self.messages)
+
+            nextTime += period
+            delay = nextTime - time.monotonic()
+            if delay > 0:
+                self.stopEvent.wait(delay)
+
+    def stop(self):
+        self.stopEvent.set()
+        self.join()
+
+
+def characteristicIndex(accessoryList):
+    """Split the characteristics of /accessories by what a controller can do"""
+
+    readable, writable, notifying = [], [], []
+    for acc in accessoryList:
+        for service in acc["services"]:
+            for char in service["characteristics"]:
+                perms = char.get("perms", [])
+                key = (acc["aid"], char["iid"])
+                if "pr" in perms:
+                    readable.append(key)
+                if "ev" in perms:
+                    notifying.append(key)
+                if "pw" in perms and (
+                    char["format"] == "bool" or char["format"] in NUMERIC_FORMATS
+                ):
+                    writable.append((acc["aid"], char["iid"], char))
+    return readable, writable, notifying
+
+
+def randomValue(char, rand):
+    if char["format"] == "bool":
+        return rand.random() < 0.5
+    if "valid-values" in char:
+        return rand.choice(char["valid-values"])
+
+    minValue = char.get("minValue", 0)
+    maxValue = char.get("maxValue", 100)
+    step = char.get("minStep", 1)
+    value = minValue + rand.randrange(int((maxValue - minValue) / step) + 1) * step
+    return round(value, 6) if char["format"] == "float" else int(value)
+
+
+async def runController(controller, port, duration, stats, seed):
+    rand = random.Random(seed)
+
+    start = time.perf_counter()
+    await controller.connect(HOST, port)
+    stats["pairVerify"].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    accessoryList = await controller.getAccessories()
+    stats["accessories"].append(time.perf_counter() - start)
+    readable, writable, notifying = characteristicIndex(accessoryList)
+
+    subscribed = rand.sample(notifying, int(len(notifying) * SUBSCRIBE_SHARE))
+    if subscribed:
+        start = time.perf_counter()
+        status, _ = await controller.subscribe(subscribed)
+        stats["subscribe"].append(time.perf_counter() - start)
+        if status not in (200, 204, 207):
+            stats["errors"] += 1
+
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        start = time.perf_counter()
+        if not writable or rand.random() < READ_SHARE:
+            ids = rand.sample(readable, min(READ_BATCH, len(readable)))
+            status, _ = await controller.readCharacteristics(ids)
+            operation = "read"
+        else:
+            aid, iid, char = rand.choice(writable)
+            status, _ = await controller.writeCharacteristics(
+                [(aid, iid, randomValue(char, rand))]
+            )
+            operation = "write"
+        stats[operation].append(time.perf_counter() - start)
+        if status not in (200, 204, 207):
+            stats["errors"] += 1
+
+    await controller.close()
+
+
+async def runControllers(controllers, port, duration):
+    stats = {
+        "pairVerify": [],
+        "accessories": [],
+        "subscribe": [],
+        "read": [],
+        "write": [],
+        "errors": 0,
+    }
+    results = await asyncio.gather(
+        *(
+            runController(controller, port, duration, stats, seed)
+            for seed, controller in enumerate(controllers)
+        ),
+        return_exceptions=True,
+    )
+    failures = [repr(result) for result in results if isinstance(result, Exception)]
+    return stats, failures
+
+
+def summarize(latencies):
+    if not latencies:
+        return None
+
+    summary = {"count": len(latencies), "max": max(latencies) * 1000}
+    if len(latencies) > 1:
+        percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+        summary["p50"] = percentiles[49] * 1000
+        summary["p90"] = percentiles[89] * 1000
+        summary["p99"] = percentiles[98] * 1000
+    else:
+        summary["p50"] = summary["p90"] = summary["p99"] = latencies[0] * 1000
+    return summary
+
+
+def benchScenario(devices, numControllers, duration, feedRate, persistDir):
+    result = {"sensors": sum(len(d["sensors"]) for d in devices)}
+    result["controllers"] = numControllers
+
+    controllers = [hap_controller.Controller() for _ in range(numControllers)]
+    driverThread = DriverThread(devices, controllers, persistDir)
+    driverThread.start()
+    driverThread.ready.wait()
+    if driverThread.error:
+        result["error"] = str(driverThread.error)
+        return result
+
+    feed = SensorFeed(driverThread.broker, stubs.makeMessages(devices), feedRate)
+    feed.start()
+    start = time.perf_counter()
+    try:
+        stats, failures = asyncio.run(
+            runControllers(controllers, driverThread.port, duration)
+        )
+    finally:
+        elapsed = time.perf_counter() - start
+        feed.stop()
+        driverThread.stop()
+
+    requests = len(stats["read"]) + len(stats["write"])
+    result["seconds"] = elapsed
+    result["requestsPerSecond"] = requests / elapsed if elapsed else None
+    result["errors"] = stats["errors"]
+    result["failedControllers"] = failures
+    result["sensorUpdates"] = feed.delivered
+    result["events"] = sum(controller.events for controller in controllers)
+    result["eventsPerSecond"] = result["events"] / elapsed if elapsed else None
+    # Latencies in milliseconds
+    for operation in ("pairVerify", "accessories", "subscribe", "read", "write"):
+        result[operation] = summarize(stats[operation])
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sensors", type=int, nargs="+", default=DEFAULT_SENSORS)
+    parser.add_argument(
+        "--controllers", type=int, nargs="+", default=DEFAULT_CONTROLLERS
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=DEFAULT_DURATION,
+        help="Seconds each controller keeps issuing requests",
+    )
+    parser.add_argument(
+        "--feed-rate",
+        type=float,
+        default=DEFAULT_FEED_RATE,
+        help="Sensor messages per second delivered to the bridge, 0 to disable",
+    )
+    parser.add_argument(
+        "--output",
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "results"),
+        help="Directory where the JSON results are stored",
+    )
+    args = parser.parse_args()
+
+    # The accessories log every sensor created, keep that out of the timings
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = []
+    with tempfile.TemporaryDirectory() as persistDir:
+        for numSensors in args.sensors:
+            devices = stubs.makeInventory(numSensors)
+            for numControllers in args.controllers:
+                result = benchScenario(
+                    devices, numControllers, args.duration, args.feed_rate, persistDir
+                )
+                results.append(result)
+                print(json.dumps(result))
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    report = {
+        "benchmark": "controllers",
+        "timestamp": now.isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "duration": args.duration,
+        "feedRate": args.feed_rate,
+        "results": results,
+    }
+    os.makedirs(args.output, exist_ok=True)
+    outputPath = os.path.join(args.output, f"controllers-{now:%Y%m%dT%H%M%S}.json")
+    with open(outputPath, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results stored in {outputPath}")
+
+
+if __name__ == "__main__":
+    main()
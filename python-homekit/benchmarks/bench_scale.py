@@ -0,0 +1,182 @@
+"""Scale benchmark for the bridge setup and the MQTT message dispatch.
+
+Builds synthetic inventories with every supported sensor kind and measures,
+for each size, the setupBridge construction time, the memory allocated per
+accessory, the callback/subscription registration cost (on setup and on a
+reconnect) and the per-message dispatch throughput, both with a message per
+quantity and with the same updates sent on the batch topics, also through
+the ingest buffer as the bridge runs it, and the time to snapshot the state
+store. The results are written as JSON so different runs
+can be compared.
+
+Usage:
+    python bench_scale.py [--sizes 10 100 1000 10000] [--output results/]
+"""
+
+import argparse
+import datetime
+import gc
+import json
+import logging
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import stubs
+
+from pyhap.accessory import Bridge
+from pyhap.accessory_driver import AccessoryDriver
+
+import bridge_setup
+import ingest
+from state_store import stateStore
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+DISPATCH_ROUNDS = 3
+
+
+def buildBridge(devices, persistDir, ingestBuffer=None):
+    driver = AccessoryDriver(
+        port=51826, persist_file=os.path.join(persistDir, "bench.state")
+    )
+    bridge = Bridge(driver, "IotCloud")
+    broker = stubs.StubBroker()
+    client = broker
+    if ingestBuffer:
+        client = ingest.BufferedClient(broker, ingestBuffer)
+    api = stubs.StubApi(devices)
+    bridge_setup.setupBridge(bridge, driver, api, client, stubs.LOCATION_ID)
+    return driver, bridge, broker
+
+
+def benchSize(numSensors, persistDir):
+    devices = stubs.makeInventory(numSensors)
+    result = {"sensors": numSensors, "devices": len(devices)}
+
+    # Construction time
+    gc.collect()
+    start = time.perf_counter()
+    driver, bridge, broker = buildBridge(devices, persistDir)
+    result["setupSeconds"] = time.perf_counter() - start
+    result["accessories"] = len(bridge.accessories)
+    result["callbacks"] = broker.numCallbacks
+    result["subscriptions"] = len(broker.subscriptions)
+    result["setupRegistrationSeconds"] = broker.registrationTime
+
+    # Memory per accessory, measured on a second build to leave the imports out
+    del driver, bridge, broker
+    gc.collect()
+    tracemalloc.start()
+    snapshotStart = tracemalloc.take_snapshot()
+    driver, bridge, broker = buildBridge(devices, persistDir)
+    snapshotEnd = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(
+        stat.size_diff for stat in snapshotEnd.compare_to(snapshotStart, "filename")
+    )
+    result["bytesPerAccessory"] = allocated / max(len(bridge.accessories), 1)
+
+    # Resubscription cost, as done by onConnect after a reconnection
+    broker.registrationTime = 0.0
+    start = time.perf_counter()
+    for acc in bridge.accessories.values():
+        acc.subscribe(broker)
+    result["resubscribeSeconds"] = time.perf_counter() - start
+
+    # Dispatch throughput, one message per quantity
+    messages = stubs.makeMessages(devices)
+    best = timeDispatch(broker, messages)
+    result["messages"] = len(messages)
+    result["dispatchSeconds"] = best
+    result["messagesPerSecond"] = len(messages) / best if best else None
+    result["microsecondsPerMessage"] = best / len(messages) * 1e6 if messages else None
+
+    # Same updates sent as batches
+    batchMessages = stubs.makeBatchMessages(devices)
+    best = timeDispatch(broker, batchMessages)
+    result["batchMessages"] = len(batchMessages)
+    result["batchDispatchSeconds"] = best
+    result["batchUpdatesPerSecond"] = len(messages) / best if best else None
+
+    # Same messages through the ingest buffer, until they are all handled
+    ingestBuffer = ingest.IngestBuffer(maxSize=max(len(messages), 1))
+    ingestBuffer.start()
+    try:
+        driver, bridge, broker = buildBridge(devices, persistDir, ingestBuffer)
+        best = timeDispatch(broker, messages, ingestBuffer)
+    finally:
+        ingestBuffer.stop()
+    result["bufferedDispatchSeconds"] = best
+    result["bufferedMessagesPerSecond"] = len(messages) / best if best else None
+    result["bufferedSuperseded"] = ingestBuffer.superseded
+
+    # Bulk read of the whole bridge state
+    start = time.perf_counter()
+    stateStore.snapshot()
+    result["snapshotSeconds"] = time.perf_counter() - start
+
+    return result
+
+
+def timeDispatch(broker, messages, ingestBuffer=None):
+    deliver = broker.deliver
+    best = None
+    for _ in range(DISPATCH_ROUNDS):
+        start = time.perf_counter()
+        for topic, payload in messages:
+            deliver(topic, payload)
+        if ingestBuffer:
+            waitDrained(ingestBuffer)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def waitDrained(ingestBuffer):
+    # Every message received is either handled, superseded or dropped
+    while (
+        ingestBuffer.processed + ingestBuffer.superseded + ingestBuffer.overflowed
+        < ingestBuffer.received
+    ):
+        time.sleep(0.0005)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument(
+        "--output",
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "results"),
+        help="Directory where the JSON results are stored",
+    )
+    args = parser.parse_args()
+
+    # The accessories log every sensor created, keep that out of the timings
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = []
+    with tempfile.TemporaryDirectory() as persistDir:
+        for numSensors in args.sizes:
+            result = benchSize(numSensors, persistDir)
+            results.append(result)
+            print(json.dumps(result))
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    report = {
+        "benchmark": "scale",
+        "timestamp": now.isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    os.makedirs(args.output, exist_ok=True)
+    outputPath = os.path.join(args.output, f"scale-{now:%Y%m%dT%H%M%S}.json")
+    with open(outputPath, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results stored in {outputPath}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""Minimal HAP controller, enough to load an AccessoryDriver like a Home hub.
+
+It runs the pair verify handshake over TCP and then speaks encrypted HTTP
+to read and write characteristics and to subscribe to their events. Pair
+setup is not implemented: the controller key has to be added to the
+driver state beforehand, see `Controller.register`.
+"""
+
+import asyncio
+import json
+import re
+import uuid
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, x25519
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+
+from pyhap import tlv
+from pyhap.const import HAP_PERMISSIONS
+from pyhap.hap_crypto import PACK_NONCE, hap_hkdf, pad_tls_nonce
+from pyhap.hap_handler import HAP_TLV_STATES, HAP_TLV_TAGS
+
+MAX_BLOCK_LENGTH = 0x400
+TAG_LENGTH = 16
+READ_SIZE = 65536
+
+CONTENT_LENGTH = re.compile(rb"content-length:\s*(\d+)", re.IGNORECASE)
+
+
+class HapError(Exception):
+    pass
+
+
+def rawPublicBytes(key):
+    return key.public_bytes(
+        encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw
+    )
+
+
+class Session:
+    """Encryption of the HAP frames once pair verify has finished"""
+
+    def __init__(self, sharedKey):
+        self.outCipher = ChaCha20Poly1305(
+            hap_hkdf(sharedKey, b"Control-Salt", b"Control-Write-Encryption-Key")
+        )
+        self.inCipher = ChaCha20Poly1305(
+            hap_hkdf(sharedKey, b"Control-Salt", b"Control-Read-Encryption-Key")
+        )
+        self.outCount = 0
+        self.inCount = 0
+        self.inBuffer = bytearray()
+
+    def encrypt(self, data):
+        frames = []
+        for offset in range(0, len(data), MAX_BLOCK_LENGTH):
+            block = data[offset : offset + MAX_BLOCK_LENGTH]
+            length = len(block).to_bytes(2, "little")
+            nonce = PACK_NONCE(self.outCount)
+            frames.append(length + self.outCipher.encrypt(nonce, block, length))
+            self.outCount += 1
+        return b"".join(frames)
+
+    def decrypt(self, data):
+        self.inBuffer += data
+        plain = bytearray()
+        while len(self.inBuffer) >= 2:
+            length = int.from_bytes(self.inBuffer[:2], "little")
+            end = 2 + length + TAG_LENGTH
+            if len(self.inBuffer) < end:
+                break
+            nonce = PACK_NONCE(self.inCount)
+            plain += self.inCipher.decrypt(
+                nonce, bytes(self.inBuffer[2:end]), bytes(self.inBuffer[:2])
+            )
+            self.inCount += 1
+            del self.inBuffer[:end]
+        return bytes(plain)
+
+
+class Controller:
+    """A paired HAP controller connection
+
+    Events received while waiting for a response are counted in `events`.
+    """
+
+    def __init__(self):
+        self.pairingId = str(uuid.uuid4()).upper().encode()
+        self.signingKey = ed25519.Ed25519PrivateKey.generate()
+        self.reader = None
+        self.writer = None
+        self.session = None
+        self.buffer = bytearray()
+        self.events = 0
+
+    def register(self, state):
+        """Add this controller to the paired clients of a driver state"""
+
+        state.add_paired_client(
+            self.pairingId,
+            rawPublicBytes(self.signingKey.public_key()),
+            HAP_PERMISSIONS.ADMIN,
+        )
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        await self.pairVerify()
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+            await self.writer.wait_closed()
+
+    async def pairVerify(self):
+        sessionKey = x25519.X25519PrivateKey.generate()
+        publicBytes = rawPublicBytes(sessionKey.public_key())
+
+        body = tlv.encode(
+            HAP_TLV_TAGS.SEQUENCE_NUM,
+            HAP_TLV_STATES.M1,
+            HAP_TLV_TAGS.PUBLIC_KEY,
+            publicBytes,
+        )
+        _, response = await self.request(
+            "POST", "/pair-verify", body, "application/pairing+tlv8"
+        )
+        objects = tlv.decode(response)
+        if HAP_TLV_TAGS.ERROR_CODE in objects:
+            raise HapError("Pair verify rejected on M2")
+
+        accessoryPublic = objects[HAP_TLV_TAGS.PUBLIC_KEY]
+        sharedKey = sessionKey.exchange(
+            x25519.X25519PublicKey.from_public_bytes(accessoryPublic)
+        )
+        verifyKey = hap_hkdf(
+            sharedKey, b"Pair-Verify-Encrypt-Salt", b"Pair-Verify-Encrypt-Info"
+        )
+
+        proof = self.signingKey.sign(publicBytes + self.pairingId + accessoryPublic)
+        subTlv = tlv.encode(
+            HAP_TLV_TAGS.USERNAME, self.pairingId, HAP_TLV_TAGS.PROOF, proof
+        )
+        encrypted = ChaCha20Poly1305(verifyKey).encrypt(
+            pad_tls_nonce(b"PV-Msg03"), subTlv, b""
+        )
+        body = tlv.encode(
+            HAP_TLV_TAGS.SEQUENCE_NUM,
+            HAP_TLV_STATES.M3,
+            HAP_TLV_TAGS.ENCRYPTED_DATA,
+            encrypted,
+        )
+        _, response = await self.request(
+            "POST", "/pair-verify", body, "application/pairing+tlv8"
+        )
+        if HAP_TLV_TAGS.ERROR_CODE in tlv.decode(response):
+            raise HapError("Pair verify rejected on M4")
+
+        self.session = Session(sharedKey)
+
+    async def request(self, method, path, body=b"", contentType="application/hap+json"):
+        message = (
+            f"{method} {path} HTTP/1.1\r\n"
+            f"Host: bridge\r\n"
+            f"Content-Type: {contentType}\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n"
+        ).encode() + body
+        if self.session:
+            message = self.session.encrypt(message)
+        self.writer.write(message)
+        await self.writer.drain()
+
+        while True:
+            startLine, responseBody = await self.readMessage()
+            if startLine.startswith(b"EVENT/"):
+                self.events += 1
+                continue
+
+            status = int(startLine.split(b" ", 2)[1])
+            return status, responseBody
+
+    async def readMessage(self):
+        while True:
+            headerEnd = self.buffer.find(b"\r\n\r\n")
+            if headerEnd != -1:
+                header = bytes(self.buffer[:headerEnd])
+                match = CONTENT_LENGTH.search(header)
+                bodyLength = int(match.group(1)) if match else 0
+                end = headerEnd + 4 + bodyLength
+                if len(self.buffer) >= end:
+                    body = bytes(self.buffer[headerEnd + 4 : end])
+                    del self.buffer[:end]
+                    return header.split(b"\r\n", 1)[0], body
+
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                raise HapError("Connection closed by the accessory")
+            self.buffer += self.session.decrypt(data) if self.session else data
+
+    async def getAccessories(self):
+        status, body = await self.request("GET", "/accessories")
+        if status != 200:
+            raise HapError(f"GET /accessories failed with {status}")
+        return json.loads(body)["accessories"]
+
+    async def readCharacteristics(self, ids):
+        query = ",".join(f"{aid}.{iid}" for aid, iid in ids)
+        return await self.request("GET", f"/characteristics?id={query}")
+
+    async def writeCharacteristics(self, values):
+        body = {
+            "characteristics": [
+                {"aid": aid, "iid": iid, "value": value} for aid, iid, value in values
+            ]
+        }
+        return await self.request("PUT", "/characteristics", json.dumps(body).encode())
+
+    async def subscribe(self, ids, enable=True):
+        body = {
+            "characteristics": [
+                {"aid": aid, "iid": iid, "ev": enable} for aid, iid in ids
+            ]
+        }
+        return await self.request("PUT", "/characteristics", json.dumps(body).encode())
@@ -0,0 +1,190 @@
+import itertools
+import os
+import sys
+import time
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.matcher import MQTTMatcher
+
+# The bridge modules use flat imports, make them importable from here
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "source")
+)
+
+# (sensorType, sensorId suffix) for every accessory kind handled by setupBridge
+SENSOR_KINDS = [
+    ("analog", "T"),
+    ("analog", "H"),
+    ("analog", "CO2"),
+    ("switch", ""),
+    ("led", ""),
+    ("ledRGB", ""),
+    ("thermostat", ""),
+]
+
+# Sample payloads, as the devices publish them, for every topic a kind listens to
+SAMPLE_PAYLOADS = {
+    ("analog", "T"): {"value": [b"21.5", b"21.6"]},
+    ("analog", "H"): {"value": [b"45.0", b"46.2"]},
+    ("analog", "CO2"): {"value": [b"950.0", b"1050.0"]},
+    ("switch", ""): {"state": [b"true", b"false"]},
+    ("led", ""): {"state": [b"true", b"false"], "aux/brightness": [b"0.5", b"0.8"]},
+    ("ledRGB", ""): {
+        "state": [b"true", b"false"],
+        "aux/brightness": [b"0.5", b"0.8"],
+        "aux/color": [b"FF00FF80", b"FF8000FF"],
+    },
+    ("thermostat", ""): {
+        "value": [b"20.5", b"20.7"],
+        "aux/humidity": [b"40.0", b"41.5"],
+        "aux/heating": [b"true", b"false"],
+        "aux/setpoint": [b"21.0", b"21.5"],
+        "state": [b"true", b"false"],
+    },
+}
+
+# The same quantities sent at once on the batch topic
+BATCH_PAYLOADS = {
+    ("analog", "T"): [b'{"value": 21.5}', b'{"value": 21.6}'],
+    ("analog", "H"): [b'{"value": 45.0}', b'{"value": 46.2}'],
+    ("analog", "CO2"): [b'{"value": 950.0}', b'{"value": 1050.0}'],
+    ("switch", ""): [b'{"state": true}', b'{"state": false}'],
+    ("led", ""): [
+        b'{"state": true, "brightness": 0.5}',
+        b'{"state": false, "brightness": 0.8}',
+    ],
+    ("ledRGB", ""): [
+        b'{"state": true, "brightness": 0.5, "color": "FF00FF80"}',
+        b'{"state": false, "brightness": 0.8, "color": "FF8000FF"}',
+    ],
+    ("thermostat", ""): [
+        b'{"value": 20.5, "humidity": 40.0, "heating": true, "setpoint": 21.0,'
+        b' "state": true}',
+        b'{"value": 20.7, "humidity": 41.5, "heating": false, "setpoint": 21.5,'
+        b' "state": false}',
+    ],
+}
+
+LOCATION_ID = "benchLocation"
+
+
+def makeInventory(numSensors, sensorsPerDevice=4):
+    """Build a synthetic device list in the format returned by the IotCloud api
+
+    The sensor kinds are interleaved so any size contains a balanced mix.
+    """
+
+    devices = []
+    kinds = itertools.cycle(SENSOR_KINDS)
+    for sensorIndex in range(numSensors):
+        if sensorIndex % sensorsPerDevice == 0:
+            device = {"deviceId": f"device{len(devices):05d}", "sensors": []}
+            devices.append(device)
+        sensorType, suffix = next(kinds)
+        sensorId = f"{device['deviceId']}_{sensorIndex:05d}{suffix}"
+        device["sensors"].append(
+            {
+                "sensorName": f"Sensor {sensorIndex}",
+                "sensorType": sensorType,
+                "sensorId": sensorId,
+            }
+        )
+    return devices
+
+
+def makeMessages(devices, locationId=LOCATION_ID):
+    """Return the (topic, payload) pairs the devices would publish, two per topic"""
+
+    messages = []
+    for device in devices:
+        for sensor in device["sensors"]:
+            kind = (sensor["sensorType"], _suffix(sensor["sensorId"]))
+            topic = f"v1/{locationId}/{device['deviceId']}/{sensor['sensorId']}/"
+            for subtopic, payloads in SAMPLE_PAYLOADS[kind].items():
+                for payload in payloads:
+                    messages.append((topic + subtopic, payload))
+    return messages
+
+
+def makeBatchMessages(devices, locationId=LOCATION_ID):
+    """Return the (topic, payload) pairs with the same updates as batches"""
+
+    messages = []
+    for device in devices:
+        for sensor in device["sensors"]:
+            kind = (sensor["sensorType"], _suffix(sensor["sensorId"]))
+            topic = f"v1/{locationId}/{device['deviceId']}/{sensor['sensorId']}/"
+            for payload in BATCH_PAYLOADS[kind]:
+                messages.append((topic + "batch", payload))
+    return messages
+
+
+def _suffix(sensorId):
+    for suffix in ("CO2", "T", "H"):
+        if sensorId.endswith(suffix):
+            return suffix
+    return ""
+
+
+class StubApi:
+    """Stand-in for IotCloudApi that serves a fixed device list"""
+
+    def __init__(self, devices):
+        self.devices = devices
+
+    def getDevices(self):
+        return self.devices
+
+
+class StubBroker:
+    """Local stand-in for the paho client and the remote broker
+
+    It keeps the same per-topic callback registry paho uses and dispatches
+    delivered messages through it, so the handler cost is measured without
+    any network in between. Time spent registering callbacks and
+    subscriptions is accumulated to be reported separately.
+    """
+
+    def __init__(self):
+        self.callbacks = MQTTMatcher()
+        self.subscriptions = set()
+        self.published = []
+        self.numCallbacks = 0
+        self.registrationTime = 0.0
+
+    def message_callback_add(self, sub, callback):
+        start = time.perf_counter()
+        self.callbacks[sub] = callback
+        self.numCallbacks += 1
+        self.registrationTime += time.perf_counter() - start
+
+    def subscribe(self, topic, qos=0):
+        start = time.perf_counter()
+        self.subscriptions.add(topic)
+        self.registrationTime += time.perf_counter() - start
+        return (mqtt.MQTT_ERR_SUCCESS, 1)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, payload, qos, retain))
+
+    def deliver(self, topic, payload):
+        msg = mqtt.MQTTMessage(topic=topic.encode("utf-8"))
+        msg.payload = payload
+        for callback in self.callbacks.iter_match(topic):
+            callback(self, None, msg)
+
+
+class StubAdvertiser:
+    """Stand-in for AsyncZeroconf, the load tests connect without mDNS"""
+
+    async def async_register_service(self, info, **kwargs):
+        pass
+
+    async def async_update_service(self, info):
+        pass
+
+    async def async_unregister_service(self, info):
+        pass
+
+    async def async_close(self):
+        pass
@@ -1,7 +1,10 @@
 import logging
 from colorsys import hsv_to_rgb, rgb_to_hsv
 
+import decoders
 import utils
+from derived_state import derivedState
+from state_store import stateStore
 
 from pyhap.accessory import Accessory
 from pyhap.const import (
@@ -14,77 +17,127 @@ from pyhap.const import (
 logger = logging.getLogger()
 
 
-class IotCloudSensor(Accessory):
+class IotCloudAccessory(Accessory):
+    """Base for the IotCloud accessories
+
+    Besides a topic per quantity, the devices can send several of them at once
+    as a json or CBOR object on the `batch` topic of the sensor, subscribed
+    to with a single wildcard for the whole location. The fields are applied
+    in one pass; the driver already sends the resulting notifications
+    together, as it coalesces the events of a connection.
+    """
+
+    # Batched field: (parser, name of the method handling it)
+    batchFields = {}
+
+    def __init__(self, driver, sensorName, sensorId, mqttclient, sensorTopic, aid=None):
+        if aid is None:
+            aid = utils.generateHash(sensorId)
+        super().__init__(driver, sensorName, aid=aid)
+        self.slot = stateStore.register(aid)
+
+        self.batchTopic = sensorTopic + "batch"
+        mqttclient.message_callback_add(
+            self.batchTopic, decoders.handler(decoders.parseBatch, self.onBatch)
+        )
+
+    def onBatch(self, fields):
+        for field, value in fields.items():
+            try:
+                parser, handlerName = self.batchFields[field]
+            except KeyError:
+                continue
+
+            try:
+                value = parser(value)
+            except decoders.DecodeError:
+                decoders.recordError(f"{self.batchTopic}:{field}", value)
+                continue
+
+            # A failing field does not stop the rest of the batch
+            try:
+                getattr(self, handlerName)(value)
+            except Exception:
+                logger.error(
+                    f"Error applying {field} from {self.batchTopic}", exc_info=True
+                )
+
+    def setValue(self, char, value):
+        char.set_value(value)
+        self.storeValue(char)
+
+    def storeValue(self, char):
+        # Also called from the setters, with the value written by a controller
+        stateStore.write(self.slot, char.display_name, char.value)
+
+
+class IotCloudSensor(IotCloudAccessory):
 
     category = CATEGORY_SENSOR
+    batchFields = {"value": (decoders.parseFloat, "onValue")}
 
-    def __init__(self, driver, sensorName, sensorId, mqttclient, sensorTopic):
-        super().__init__(driver, sensorName, aid=utils.generateHash(sensorId))
+    def __init__(self, driver, sensorName, sensorId, mqttclient, sensorTopic, aid=None):
+        super().__init__(driver, sensorName, sensorId, mqttclient, sensorTopic, aid)
 
         self.valuesTopic = sensorTopic + "value"
-        mqttclient.message_callback_add(self.valuesTopic, self.onValue)
-
-        self.lastValue = 0.0
+        mqttclient.message_callback_add(
+            self.valuesTopic, decoders.handler(decoders.parseFloat, self.onValue)
+        )
 
     def subscribe(self, mqttclient):
         mqttclient.subscribe(self.valuesTopic)
 
-    def onValue(self, client, userdata, msg):
-        try:
-            # Just remember the latest value
-            value = float(msg.payload)
-            self.char_sensor.set_value(value)
-        except ValueError:
-            logger.error(f"The value received: {msg.payload} is not valid")
-            value = 0.0
-
-        self.lastValue = value
+    def onValue(self, value):
+        self.setValue(self.char_sensor, value)
 
     def getValue(self):
-        return self.lastValue
+        return stateStore.read(self.slot, self.char_sensor.display_name, 0.0)
 
 
 class HumSensor(IotCloudSensor):
-    def __init__(self, driver, sensorName, sensorId, mqttclient, sensorTopic):
+    def __init__(self, driver, sensorName, sensorId, mqttclient, sensorTopic, aid=None):
 
-        super().__init__(driver, sensorName, sensorId, mqttclient, sensorTopic)
+        super().__init__(driver, sensorName, sensorId, mqttclient, sensorTopic, aid)
         serv = self.add_preload_service("HumiditySensor")
         self.char_sensor = serv.configure_char("CurrentRelativeHumidity")
         self.subscribe(mqttclient)
 
 
 class TempSensor(IotCloudSensor):
-    def __init__(self, driver, sensorName, sensorId, mqttclient, sensorTopic):
+    def __init__(self, driver, sensorName, sensorId, mqttclient, sensorTopic, aid=None):
 
-        super().__init__(driver, sensorName, sensorId, mqttclient, sensorTopic)
+        super().__init__(driver, sensorName, sensorId, mqttclient, sensorTopic, aid)
         serv = self.add_preload_service("TemperatureSensor")
         self.char_sensor = serv.configure_char("CurrentTemperature")
         self.subscribe(mqttclient)
 
 
 class CO2Sensor(IotCloudSensor):
-    def __init__(self, driver, sensorName, sensorId, mqttclient, sensorTopic):
+    def __init__(self, driver, sensorName, sensorId, mqttclient, sensorTopic, aid=None):
 
-        super().__init__(driver, sensorName, sensorId, mqttclient, sensorTopic)
+        super().__init__(driver, sensorName, sensorId, mqttclient, sensorTopic, aid)
         serv = self.add_preload_service("CarbonDioxideSensor", ["CarbonDioxideLevel"])
         self.char_sensor = serv.configure_char("CarbonDioxideLevel")
         self.char_CO2_detected = serv.configure_char("CarbonDioxideDetected")
-        self.maxCO2Level = 1000.0
+        # Evaluated with hysteresis from the latest levels
+        derivedState.addListener("CO2Detected", self.slot, self.onCO2Detected)
 
         self.subscribe(mqttclient)
 
-    def onValue(self, client, userdata, msg):
-        super().onValue(client, userdata, msg)
-
-        self.char_CO2_detected.set_value(self.lastValue > self.maxCO2Level)
+    def onCO2Detected(self, detected):
+        self.setValue(self.char_CO2_detected, detected)
 
 
-class IotCloudLight(Accessory):
+class IotCloudLight(IotCloudAccessory):
 
     category = CATEGORY_LIGHTBULB
+    batchFields = {
+        "state": (decoders.parseBoolean, "onState"),
+        "brightness": (decoders.parseFloat, "onBrightness"),
+    }
 
-    def __init__(self, driver, sensorName, sensorId, mqttclient, sensorTopic):
-        super().__init__(driver, sensorName, aid=utils.generateHash(sensorId))
+    def __init__(self, driver, sensorName, sensorId, mqttclient, sensorTopic, aid=None):
+        super().__init__(driver, sensorName, sensorId, mqttclient, sensorTopic, aid)
 
         self.stateTopic = sensorTopic + "state"
         self.setStateTopic = sensorTopic + "setState"
@@ -92,44 +145,37 @@ class IotCloudLight(Accessory):
         self.setBrightnessTopic = sensorTopic + "aux/setBrightness"
 
         self.mqttclient = mqttclient
-        mqttclient.message_callback_add(self.stateTopic, self.onState)
-        mqttclient.message_callback_add(self.brightnessTopic, self.onBrightness)
+        mqttclient.message_callback_add(
+            self.stateTopic, decoders.handler(decoders.parseBoolean, self.onState)
+        )
+        mqttclient.message_callback_add(
+            self.brightnessTopic,
+            decoders.handler(decoders.parseFloat, self.onBrightness),
+        )
 
     def subscribe(self, mqttclient):
         mqttclient.subscribe(self.stateTopic)
         mqttclient.subscribe(self.brightnessTopic)
 
-    def onState(self, client, userdata, msg):
-
-        try:
-            status = utils.decodeBoolean(msg.payload)
-        except:
-            logger.error(f"The state received: {msg.payload} is not valid")
-            return
-
-        self.charOn.set_value(status)
-
-    def onBrightness(self, client, userdata, msg):
+    def onState(self, status):
+        self.setValue(self.charOn, status)
 
-        try:
-            brightness = float(msg.payload)
-        except ValueError:
-            logger.error(f"The brightness received: {msg.payload} is not valid")
-            return
-
-        self.charBrightness.set_value(int(brightness * 100.0))
+    def onBrightness(self, brightness):
+        self.setValue(self.charBrightness, int(brightness * 100.0))
 
     def setState(self, value):
+        self.storeValue(self.charOn)
         self.mqttclient.publish(self.setStateTopic, value, qos=2)
 
     def setBrightness(self, value):
+        self.storeValue(self.charBrightness)
         brightness = value / 100.0
         self.mqttclient.publish(self.setBrightnessTopic, brightness, qos=2)
 
 
 class LedLight(IotCloudLight):
-    def __init__(self, driver, sensorName, sensorId, mqttclient, sensorTopic):
-        super().__init__(driver, sensorName, sensorId, mqttclient, sensorTopic)
+    def __init__(self, driver, sensorName, sensorId, mqttclient, sensorTopic, aid=None):
+        super().__init__(driver, sensorName, sensorId, mqttclient, sensorTopic, aid)
 
         serv_light = self.add_preload_service("Lightbulb", ["Brightness"])
         self.charOn = serv_light.configure_char("On", setter_callback=self.setState)
@@ -141,8 +187,14 @@ class LedLight(IotCloudLight):
 
 
 class RGBLight(IotCloudLight):
-    def __init__(self, driver, sensorName, sensorId, mqttclient, sensorTopic):
-        super().__init__(driver, sensorName, sensorId, mqttclient, sensorTopic)
+
+    batchFields = {
+        **IotCloudLight.batchFields,
+        "color": (decoders.parseHexColor, "onColor"),
+    }
+
+    def __init__(self, driver, sensorName, sensorId, mqttclient, sensorTopic, aid=None):
+        super().__init__(driver, sensorName, sensorId, mqttclient, sensorTopic, aid)
 
         serv_light = self.add_preload_service(
             "Lightbulb", ["Brightness", "Hue", "Saturation"]
@@ -155,45 +207,44 @@ class RGBLight(IotCloudLight):
         self.charSat = serv_light.configure_char(
             "Saturation", setter_callback=self.setSaturation
         )
-        self.saturation = 0.0
 
         self.colorTopic = sensorTopic + "aux/color"
         self.setColorTopic = sensorTopic + "aux/setColor"
 
-        mqttclient.message_callback_add(self.colorTopic, self.onColor)
+        mqttclient.message_callback_add(
+            self.colorTopic, decoders.handler(decoders.parseHexColor, self.onColor)
+        )
         self.subscribe(mqttclient)
 
     def subscribe(self, mqttclient):
         super().subscribe(mqttclient)
         mqttclient.subscribe(self.colorTopic)
 
-    def onColor(self, client, userdata, msg):
-
-        hexColor = msg.payload
-
-        h, s, v = rgb_to_hsv(
-            int(hexColor[2:4], 16), int(hexColor[4:6], 16), int(hexColor[6:8], 16)
-        )
-        self.charHue.set_value(int(h * 360.0))
-        self.charSat.set_value(int(s * 100.0))
+    def onColor(self, color):
+        h, s, v = rgb_to_hsv(*color)
+        self.setValue(self.charHue, int(h * 360.0))
+        self.setValue(self.charSat, int(s * 100.0))
 
     def setSaturation(self, value):
-        self.saturation = value / 100.0
+        self.storeValue(self.charSat)
 
     def setHue(self, hue):
+        self.storeValue(self.charHue)
+        saturation = stateStore.read(self.slot, self.charSat.display_name, 0.0) / 100.0
         hexColor = "FF%02x%02x%02x" % tuple(
-            map(lambda x: int(x * 255), hsv_to_rgb(hue / 360.0, self.saturation, 1.0))
+            map(lambda x: int(x * 255), hsv_to_rgb(hue / 360.0, saturation, 1.0))
         )
         logger.debug(f"Setting color to {hexColor}")
         self.mqttclient.publish(self.setColorTopic, hexColor, qos=2, retain=True)
 
 
-class Switch(Accessory):
+class Switch(IotCloudAccessory):
 
     category = CATEGORY_SWITCH
+    batchFields = {"state": (decoders.parseBoolean, "onState")}
 
-    def __init__(self, driver, sensorName, sensorId, mqttclient, sensorTopic):
-        super().__init__(driver, sensorName, aid=utils.generateHash(sensorId))
+    def __init__(self, driver, sensorName, sensorId, mqttclient, sensorTopic, aid=None):
+        super().__init__(driver, sensorName, sensorId, mqttclient, sensorTopic, aid)
 
         serv_light = self.add_preload_service("Switch")
         self.char = serv_light.configure_char("On", setter_callback=self.setState)
@@ -202,32 +253,35 @@ class Switch(Accessory):
         self.setStateTopic = sensorTopic + "setState"
 
         self.mqttclient = mqttclient
-        mqttclient.message_callback_add(self.stateTopic, self.onState)
+        mqttclient.message_callback_add(
+            self.stateTopic, decoders.handler(decoders.parseBoolean, self.onState)
+        )
         self.subscribe(mqttclient)
 
     def subscribe(self, mqttclient):
         mqttclient.subscribe(self.stateTopic)
 
-    def onState(self, client, userdata, msg):
-
-        try:
-            status = utils.decodeBoolean(msg.payload)
-        except:
-            logger.error(f"The state received: {msg.payload} is not valid")
-            return
-
-        self.char.set_value(status)
+    def onState(self, status):
+        self.setValue(self.char, status)
 
     def setState(self, value):
+        self.storeValue(self.char)
         self.mqttclient.publish(self.setStateTopic, value, qos=2)
 
 
-class Thermostat(Accessory):
+class Thermostat(IotCloudAccessory):
 
     category = CATEGORY_THERMOSTAT
+    batchFields = {
+        "value": (decoders.parseFloat, "onTempValue"),
+        "humidity": (decoders.parseFloat, "onHumValue"),
+        "heating": (decoders.parseBoolean, "onHeating"),
+        "setpoint": (decoders.parseFloat, "onSetpointValue"),
+        "state": (decoders.parseBoolean, "onState"),
+    }
 
-    def __init__(self, driver, sensorName, sensorId, mqttclient, sensorTopic):
-        super().__init__(driver, sensorName, aid=utils.generateHash(sensorId))
+    def __init__(self, driver, sensorName, sensorId, mqttclient, sensorTopic, aid=None):
+        super().__init__(driver, sensorName, sensorId, mqttclient, sensorTopic, aid)
 
         serv = self.add_preload_service("Thermostat", ["CurrentRelativeHumidity"])
         self.charHeatingState = serv.configure_char("CurrentHeatingCoolingState")
@@ -249,11 +303,23 @@ class Thermostat(Accessory):
         self.setpointTopic = sensorTopic + "aux/setpoint"
 
         self.mqttclient = mqttclient
-        mqttclient.message_callback_add(self.stateTopic, self.onState)
-        mqttclient.message_callback_add(self.temperatureTopic, self.onTempValue)
-        mqttclient.message_callback_add(self.humidityTopic, self.onHumValue)
-        mqttclient.message_callback_add(self.heatingTopic, self.onHeating)
-        mqttclient.message_callback_add(self.setpointTopic, self.onSetpointValue)
+        mqttclient.message_callback_add(
+            self.stateTopic, decoders.handler(decoders.parseBoolean, self.onState)
+        )
+        mqttclient.message_callback_add(
+            self.temperatureTopic,
+            decoders.handler(decoders.parseFloat, self.onTempValue),
+        )
+        mqttclient.message_callback_add(
+            self.humidityTopic, decoders.handler(decoders.parseFloat, self.onHumValue)
+        )
+        mqttclient.message_callback_add(
+            self.heatingTopic, decoders.handler(decoders.parseBoolean, self.onHeating)
+        )
+        mqttclient.message_callback_add(
+            self.setpointTopic,
+            decoders.handler(decoders.parseFloat, self.onSetpointValue),
+        )
         self.subscribe(mqttclient)
 
     def subscribe(self, mqttclient):
@@ -263,53 +329,28 @@ class Thermostat(Accessory):
         mqttclient.subscribe(self.heatingTopic)
         mqttclient.subscribe(self.setpointTopic)
 
-    def onTempValue(self, client, userdata, msg):
-        try:
-            # Just remember the latest value
-            value = float(msg.payload)
-            self.charCurrentTemp.set_value(value)
-        except ValueError:
-            logger.error(f"The value received: {msg.payload} is not valid")
-
-    def onSetpointValue(self, client, userdata, msg):
-        try:
-            # Just remember the latest value
-            value = float(msg.payload)
-            self.charTargetTemp.set_value(value)
-        except ValueError:
-            logger.error(f"The value received: {msg.payload} is not valid")
-
-    def onHumValue(self, client, userdata, msg):
-        try:
-            # Just remember the latest value
-            value = float(msg.payload)
-            self.charHum.set_value(value)
-        except ValueError:
-            logger.error(f"The value received: {msg.payload} is not valid")
+    def onTempValue(self, value):
+        self.setValue(self.charCurrentTemp, value)
+
+    def onSetpointValue(self, value):
+        self.setValue(self.charTargetTemp, value)
+
+    def onHumValue(self, value):
+        self.setValue(self.charHum, value)
 
     def setState(self, value):
+        self.storeValue(self.charTargetHeatingState)
         newState = value != 0
         self.mqttclient.publish(self.setStateTopic, newState, qos=2)
 
     def setSetpoint(self, value):
+        self.storeValue(self.charTargetTemp)
         self.mqttclient.publish(self.setpointTopic, value, qos=2, retain=True)
 
-    def onState(self, client, userdata, msg):
-
-        try:
-            status = utils.decodeBoolean(msg.payload)
-        except:
-            logger.error(f"The state received: {msg.payload} is not valid")
-
+    def onState(self, status):
         mode = 3 if status else 0
-        self.charTargetHeatingState.set_value(mode)
-
-    def onHeating(self, client, userdata, msg):
-
-        try:
-            status = utils.decodeBoolean(msg.payload)
-        except:
-            logger.error(f"The state received: {msg.payload} is not valid")
+        self.setValue(self.charTargetHeatingState, mode)
 
+    def onHeating(self, status):
         # 0: off, 1: heating
-        self.charHeatingState.set_value(int(status))
+        self.setValue(self.charHeatingState, int(status))
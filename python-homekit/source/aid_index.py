@@ -0,0 +1,69 @@
+import json
+import logging
+import os
+
+import utils
+
+logger = logging.getLogger()
+
+# 1 is the bridge itself and 0 is not a valid accessory id
+RESERVED_AIDS = {0, 1}
+
+
+class AidIndex:
+    """Accessory ids by sensorId, persisted so they never change
+
+    A new sensor gets the hash of its sensorId. If that id is already taken
+    the sensorId is hashed again with an increasing suffix, so the result
+    only depends on the sensors known and the order they are added in.
+    Without a path the index only lives in memory.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.aids = {}
+        self.changed = False
+
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.aids = {
+                        sensorId: int(aid) for sensorId, aid in json.load(f).items()
+                    }
+            except (OSError, ValueError, AttributeError):
+                logger.error(f"Unable to load the accessory ids from {path}")
+
+        self.usedAids = set(self.aids.values())
+
+    def getAid(self, sensorId):
+        try:
+            return self.aids[sensorId]
+        except KeyError:
+            pass
+
+        aid = utils.generateHash(sensorId)
+        attempt = 0
+        while aid in self.usedAids or aid in RESERVED_AIDS:
+            attempt += 1
+            aid = utils.generateHash(f"{sensorId}#{attempt}")
+        if attempt:
+            logger.warning(f"Accessory id collision for {sensorId}, using {aid}")
+
+        self.aids[sensorId] = aid
+        self.usedAids.add(aid)
+        self.changed = True
+        return aid
+
+    def save(self):
+        if not self.path or not self.changed:
+            return
+
+        tmpPath = self.path + ".tmp"
+        try:
+            with open(tmpPath, "w") as f:
+                json.dump(self.aids, f, indent=1, sort_keys=True)
+            os.replace(tmpPath, self.path)
+        except OSError:
+            logger.error(f"Unable to save the accessory ids to {self.path}")
+            return
+        self.changed = False
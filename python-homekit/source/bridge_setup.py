@@ -0,0 +1,149 @@
+import logging
+import threading
+import time
+
+import accessories
+import aid_index
+
+logger = logging.getLogger()
+
+DEFAULT_CHECK_DELAY = 30.0
+CHECK_RETRY_DELAY = 300.0
+
+
+def inventorySignature(devices):
+    """Everything from the devices list that ends up in the accessory database"""
+
+    return sorted(
+        (sensor["sensorId"], sensor["sensorType"], sensor["sensorName"], deviceId)
+        for deviceId, sensor in iterSensors(devices)
+    )
+
+
+def iterSensors(devices):
+    for device in devices:
+        for sensor in device["sensors"]:
+            yield device["deviceId"], sensor
+
+
+def setupBridge(bridge, driver, api, mqttclient, locationId, aidIndex=None):
+    """Add an accessory for every supported sensor and return the inventory signature
+
+    The sensors are processed sorted by sensorId and the accessories are
+    added sorted by aid, so neither the ids nor the accessory database
+    depend on the order the api returns the devices in.
+    """
+
+    if aidIndex is None:
+        aidIndex = aid_index.AidIndex()
+
+    devices = api.getDevices()
+    sensors = sorted(iterSensors(devices), key=lambda item: item[1]["sensorId"])
+    newAccessories = []
+    for deviceId, sensor in sensors:
+        sensorName = sensor["sensorName"]
+        sensorType = sensor["sensorType"]
+        sensorId = sensor["sensorId"]
+        logger.info(sensorId)
+        topic = f"v1/{locationId}/{deviceId}/{sensorId}/"
+
+        if sensorType == "analog":
+            if sensorId.endswith("T"):
+                accessoryClass = accessories.TempSensor
+            elif sensorId.endswith("H"):
+                accessoryClass = accessories.HumSensor
+            elif sensorId.endswith("CO2"):
+                accessoryClass = accessories.CO2Sensor
+            else:
+                logger.error(f"Analog sensor {sensorId} not supported")
+                continue
+
+        elif sensorType == "switch":
+            accessoryClass = accessories.Switch
+        elif sensorType == "led":
+            accessoryClass = accessories.LedLight
+        elif sensorType == "ledRGB":
+            accessoryClass = accessories.RGBLight
+        elif sensorType == "thermostat":
+            accessoryClass = accessories.Thermostat
+        else:
+            logger.error(f"Sensor type {sensorType} not supported")
+            continue
+
+        acc = accessoryClass(
+            driver,
+            sensorName,
+            sensorId,
+            mqttclient,
+            topic,
+            aid=aidIndex.getAid(sensorId),
+        )
+        newAccessories.append(acc)
+
+    for acc in sorted(newAccessories, key=lambda acc: acc.aid):
+        bridge.add_accessory(acc)
+
+    aidIndex.save()
+    return inventorySignature(devices)
+
+
+class InventoryWatcher:
+    """Checks the devices list when it is reported to change, out of the MQTT thread
+
+    A report only schedules a check `delay` seconds after the last one, so a
+    bulk edit of many sensors ends up in a single api call. `onChanged` is
+    called once if the devices no longer match `signature`, the inventory
+    the bridge was built from. A failed check is retried later.
+    """
+
+    def __init__(self, api, onChanged, signature=None, delay=DEFAULT_CHECK_DELAY):
+        self.api = api
+        self.onChanged = onChanged
+        self.signature = signature
+        self.delay = delay
+        self.condition = threading.Condition()
+        self.dueTime = None
+        self.thread = None
+
+    def request(self):
+        with self.condition:
+            self.dueTime = time.monotonic() + self.delay
+            self.condition.notify()
+
+    def waitDue(self):
+        with self.condition:
+            while True:
+                if self.dueTime is None:
+                    self.condition.wait()
+                    continue
+                remaining = self.dueTime - time.monotonic()
+                if remaining <= 0:
+                    self.dueTime = None
+                    return
+                self.condition.wait(remaining)
+
+    def run(self):
+        while True:
+            self.waitDue()
+            try:
+                signature = inventorySignature(self.api.getDevices())
+            except Exception:
+                logger.error("Unable to get the devices", exc_info=True)
+                with self.condition:
+                    if self.dueTime is None:
+                        self.dueTime = time.monotonic() + CHECK_RETRY_DELAY
+                continue
+
+            if signature == self.signature:
+                logger.info("The accessories did not change")
+                continue
+
+            logger.info("The accessories changed")
+            self.onChanged()
+            return
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name="homekit-inventory", daemon=True
+        )
+        self.thread.start()
@@ -0,0 +1,241 @@
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger()
+
+DEFAULT_INFLIGHT_WINDOW = 20
+DEFAULT_DEVICE_WINDOW = 4
+STATS_LOG_INTERVAL = 300.0
+
+
+def deviceOf(topic):
+    """Commands are ordered per device: v1/{locationId}/{deviceId}"""
+
+    return "/".join(topic.split("/", 3)[:3])
+
+
+class Command:
+    def __init__(self, device, topic, payload, qos, retain):
+        self.device = device
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.queuedTime = time.monotonic()
+        self.sentTime = None
+
+
+class CommandScheduler:
+    """Outbound command pipeline in front of the paho client
+
+    Commands are queued per device and sent in FIFO order on the connection,
+    with at most `deviceWindow` commands in flight per device and
+    `inflightWindow` in total. The devices with pending commands are served
+    in turns, so a long scene does not starve the rest. A queued command is dropped when a newer
+    one to the same topic arrives, and the newer one goes to the back of the
+    queue, so the last command sent is always the last one received. The
+    metrics are logged periodically. Everything but `publish` is forwarded
+    to the wrapped client.
+
+    When the connection is replaced `setClient` has to be called with the
+    new paho client before it is used: the commands in flight on the
+    previous one are sent again, and its late acknowledgements ignored, as
+    the message ids of each client are independent.
+    """
+
+    def __init__(
+        self,
+        mqttclient,
+        inflightWindow=DEFAULT_INFLIGHT_WINDOW,
+        deviceWindow=DEFAULT_DEVICE_WINDOW,
+    ):
+        self.mqttclient = mqttclient
+        self.inflightWindow = inflightWindow
+        self.deviceWindow = deviceWindow
+        self.lock = threading.Lock()
+        self.queues = collections.OrderedDict()  # device: deque of commands
+        self.deviceInflight = collections.Counter()
+        self.client = None  # paho client the commands are published on
+        self.inflight = {}  # (client, mid): command
+        self.completedEarly = set()
+        self.sending = 0
+
+        # Metrics
+        self.submitted = 0
+        self.sent = 0
+        self.superseded = 0
+        self.failed = 0
+        self.totalQueueTime = 0.0
+        self.maxQueueTime = 0.0
+        self.totalCompletionTime = 0.0
+        self.completed = 0
+        self.lastStatsLog = time.monotonic()
+
+        mqttclient.max_inflight_messages_set(inflightWindow)
+        mqttclient.on_publish = self.onPublish
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        device = deviceOf(topic)
+        with self.lock:
+            self.submitted += 1
+            queue = self.queues.setdefault(device, collections.deque())
+            for command in queue:
+                if command.topic == topic:
+                    queue.remove(command)
+                    self.superseded += 1
+                    break
+            queue.append(Command(device, topic, payload, qos, retain))
+            commands = self.schedule()
+
+        self.send(commands)
+        self.logStats()
+
+    def schedule(self):
+        """Pick the next commands to send. Must be called with the lock held"""
+
+        commands = []
+        available = self.inflightWindow - len(self.inflight) - self.sending
+        # One command per device and turn, until the windows are full
+        picked = True
+        while picked and len(commands) < available:
+            picked = False
+            for device in list(self.queues):
+                if len(commands) >= available:
+                    break
+                if self.deviceInflight[device] >= self.deviceWindow:
+                    continue
+
+                queue = self.queues.pop(device)
+                command = queue.popleft()
+                if queue:
+                    # Back of the line for its next command
+                    self.queues[device] = queue
+                self.deviceInflight[device] += 1
+                commands.append(command)
+                picked = True
+
+        self.sending += len(commands)
+        return commands
+
+    def send(self, commands):
+        # Paho calls on_publish holding its own locks, so never publish with ours
+        for command in commands:
+            command.sentTime = time.monotonic()
+            client = self.client or self.mqttclient
+            try:
+                info = client.publish(
+                    command.topic,
+                    command.payload,
+                    qos=command.qos,
+                    retain=command.retain,
+                )
+            except Exception:
+                logger.error(f"Unable to publish on {command.topic}", exc_info=True)
+                with self.lock:
+                    self.sending -= 1
+                    self.failed += 1
+                    self.release(command)
+                    nextCommands = self.schedule()
+                self.send(nextCommands)
+                continue
+
+            with self.lock:
+                self.sending -= 1
+                self.sent += 1
+                queueTime = command.sentTime - command.queuedTime
+                self.totalQueueTime += queueTime
+                self.maxQueueTime = max(self.maxQueueTime, queueTime)
+                key = (client, info.mid)
+                if key in self.completedEarly or (command.qos == 0 and info.rc):
+                    # QoS 0 messages that could not be sent are not retried
+                    self.completedEarly.discard(key)
+                    self.complete(command)
+                    nextCommands = self.schedule()
+                elif self.client is not None and client is not self.client:
+                    # Sent on a connection replaced meanwhile
+                    self.requeue(command)
+                    nextCommands = self.schedule()
+                else:
+                    self.inflight[key] = command
+                    nextCommands = []
+            self.send(nextCommands)
+
+    def onPublish(self, client, userdata, mid, *args):
+        with self.lock:
+            if self.client is not None and client is not self.client:
+                # Late acknowledgement from a replaced connection
+                return
+            command = self.inflight.pop((client, mid), None)
+            if command is None:
+                if self.sending:
+                    # Acknowledged before publish returned its mid
+                    self.completedEarly.add((client, mid))
+                return
+            self.complete(command)
+            commands = self.schedule()
+
+        self.send(commands)
+        self.logStats()
+
+    def setClient(self, client):
+        """Publish on a new paho client, sending again the commands in flight"""
+
+        with self.lock:
+            self.client = client
+            # Back to the front of their queues in the order they were sent
+            for command in sorted(
+                self.inflight.values(), key=lambda c: c.sentTime, reverse=True
+            ):
+                self.requeue(command)
+            self.inflight.clear()
+            self.completedEarly.clear()
+            commands = self.schedule()
+
+        self.send(commands)
+
+    def requeue(self, command):
+        queue = self.queues.setdefault(command.device, collections.deque())
+        # Unless a newer command to the same topic is already waiting
+        if all(queued.topic != command.topic for queued in queue):
+            queue.appendleft(command)
+        self.release(command)
+
+    def complete(self, command):
+        self.completed += 1
+        self.totalCompletionTime += time.monotonic() - command.sentTime
+        self.release(command)
+
+    def release(self, command):
+        self.deviceInflight[command.device] -= 1
+        if not self.deviceInflight[command.device]:
+            del self.deviceInflight[command.device]
+
+    def logStats(self):
+        now = time.monotonic()
+        if now - self.lastStatsLog < STATS_LOG_INTERVAL:
+            return
+        self.lastStatsLog = now
+        logger.info(f"Command scheduler: {self.stats()}")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queued": sum(len(queue) for queue in self.queues.values()),
+                "inflight": len(self.inflight),
+                "submitted": self.submitted,
+                "sent": self.sent,
+                "superseded": self.superseded,
+                "failed": self.failed,
+                "avgQueueSeconds": (
+                    self.totalQueueTime / self.sent if self.sent else 0.0
+                ),
+                "maxQueueSeconds": self.maxQueueTime,
+                "avgCompletionSeconds": (
+                    self.totalCompletionTime / self.completed if self.completed else 0.0
+                ),
+            }
+
+    def __getattr__(self, name):
+        return getattr(self.mqttclient, name)
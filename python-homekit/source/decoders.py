@@ -0,0 +1,132 @@
+import collections
+import json
+import logging
+import math
+import re
+import time
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+logger = logging.getLogger()
+
+STATS_LOG_INTERVAL = 300.0
+ERROR_SUMMARY_TOPICS = 10
+
+# Number of payloads that could not be decoded, by topic
+errorCounts = collections.Counter()
+_lastErrorSummary = time.monotonic()
+
+_BOOLEANS = {b"true": True, b"false": False}
+_HEX_COLOR = re.compile(rb"[0-9A-Fa-f]{8}")
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def parseFloat(payload):
+    if isinstance(payload, bool):
+        raise DecodeError("Not a number")
+
+    try:
+        value = float(payload)
+    except (TypeError, ValueError):
+        raise DecodeError("Not a number")
+
+    if not math.isfinite(value):
+        raise DecodeError("Not a finite number")
+    return value
+
+
+def parseBoolean(payload):
+    # Already decoded from a batched payload
+    if isinstance(payload, bool):
+        return payload
+
+    if isinstance(payload, str):
+        payload = payload.encode()
+    try:
+        return _BOOLEANS[payload.lower()]
+    except (AttributeError, KeyError, TypeError):
+        raise DecodeError("Not a boolean")
+
+
+def parseHexColor(payload):
+    """Decode an AARRGGBB hex color and return its (red, green, blue) components"""
+
+    if isinstance(payload, str):
+        payload = payload.encode()
+    if not isinstance(payload, bytes) or not _HEX_COLOR.fullmatch(payload):
+        raise DecodeError("Not an hex color")
+
+    color = int(payload, 16)
+    return (color >> 16) & 0xFF, (color >> 8) & 0xFF, color & 0xFF
+
+
+def parseJson(payload):
+    try:
+        return json.loads(payload)
+    except (TypeError, ValueError):
+        raise DecodeError("Not a json document")
+
+
+def parseBatch(payload):
+    """Decode a json or CBOR (if cbor2 is installed) object with several fields
+
+    The field values can be given to the rest of the parsers.
+    """
+
+    if cbor2 and payload[:1] and 0xA0 <= payload[0] <= 0xBF:
+        try:
+            fields = cbor2.loads(payload)
+        except (TypeError, ValueError):
+            raise DecodeError("Not a CBOR document")
+    else:
+        fields = parseJson(payload)
+
+    if not isinstance(fields, dict):
+        raise DecodeError("Not a batch of fields")
+    return fields
+
+
+def recordError(topic, payload):
+    errorCounts[topic] += 1
+    logger.error(f"The payload received on {topic}: {payload} is not valid")
+    logErrorSummary()
+
+
+def logErrorSummary():
+    """Log the invalid payload counts, at most once every STATS_LOG_INTERVAL"""
+
+    global _lastErrorSummary
+
+    now = time.monotonic()
+    if now - _lastErrorSummary < STATS_LOG_INTERVAL:
+        return
+    _lastErrorSummary = now
+    logger.warning(
+        f"{sum(errorCounts.values())} invalid payloads received, most frequent: "
+        f"{errorCounts.most_common(ERROR_SUMMARY_TOPICS)}"
+    )
+
+
+def handler(parser, callback):
+    """Build an MQTT message callback that decodes the payload with `parser`
+
+    `callback` only receives valid values. The payloads that cannot be
+    decoded are logged and counted in `errorCounts`.
+    """
+
+    def onMessage(client, userdata, msg):
+        try:
+            value = parser(msg.payload)
+        except DecodeError:
+            recordError(msg.topic, msg.payload)
+            return
+
+        callback(value)
+
+    return onMessage
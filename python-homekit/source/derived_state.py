@@ -0,0 +1,170 @@
+import array
+import logging
+import math
+import operator
+import threading
+import time
+
+from state_store import stateStore
+
+logger = logging.getLogger()
+
+DEFAULT_INTERVAL = 5.0
+
+
+class Rule:
+    """Binary signal derived from the state store, with hysteresis
+
+    The input is a characteristic column, or the difference of two of them.
+    The signal turns on above `onAbove`, off below `offBelow`, and once it
+    changes it holds for at least `minHold` seconds.
+    """
+
+    def __init__(self, name, inputs, onAbove, offBelow, minHold=0.0):
+        if isinstance(inputs, str) or not all(isinstance(n, str) for n in inputs):
+            raise ValueError("The inputs must be a list of characteristic names")
+        if not 1 <= len(inputs) <= 2:
+            raise ValueError("A rule takes one or two inputs")
+        if offBelow > onAbove:
+            raise ValueError("offBelow must not be above onAbove")
+        if minHold < 0:
+            raise ValueError("minHold must not be negative")
+
+        self.name = name
+        self.inputs = inputs
+        self.onAbove = onAbove
+        self.offBelow = offBelow
+        self.minHold = minHold
+
+    @classmethod
+    def fromDict(cls, data):
+        return cls(
+            data["name"],
+            data["inputs"],
+            float(data["onAbove"]),
+            float(data["offBelow"]),
+            float(data.get("minHold", 0.0)),
+        )
+
+
+# Only the rules with a listener, the others are configured in derived_rules
+DEFAULT_RULES = [
+    Rule("CO2Detected", ["CarbonDioxideLevel"], 1000.0, 900.0, minHold=60.0),
+]
+
+
+def loadRules(configs):
+    """Return the default rules, replaced or extended by the configured ones
+
+    A configured rule replaces the default rule of the same name, any other
+    signal is added with its own rule. Invalid rules are logged and skipped.
+    """
+
+    rules = {rule.name: rule for rule in DEFAULT_RULES}
+    for data in configs:
+        try:
+            rule = Rule.fromDict(data)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            logger.error(f"Invalid derived rule {data}: {e}")
+            continue
+        rules[rule.name] = rule
+    return list(rules.values())
+
+
+class DerivedStateEngine:
+    """Evaluates the rules over every accessory at once, on a timer
+
+    The signals are written back to the state store, as a column named
+    after the rule, and the listeners of an accessory slot are called when
+    its signal changes.
+    """
+
+    def __init__(self, store, rules=None, interval=DEFAULT_INTERVAL):
+        self.store = store
+        self.interval = interval
+        self.rules = []
+        self.changedAt = {}  # rule name: array of change times by slot
+        self.listeners = {}  # rule name: {slot: callback}
+        self.thread = None
+        for rule in DEFAULT_RULES if rules is None else rules:
+            self.addRule(rule)
+
+    def addRule(self, rule):
+        self.rules.append(rule)
+        self.changedAt[rule.name] = array.array("d")
+        self.listeners.setdefault(rule.name, {})
+
+    def setRules(self, rules):
+        self.rules = []
+        for rule in rules:
+            self.addRule(rule)
+
+    def addListener(self, ruleName, slot, callback):
+        self.listeners.setdefault(ruleName, {})[slot] = callback
+
+    def evaluate(self, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        for rule in self.rules:
+            columns = [self.store.columns.get(name) for name in rule.inputs]
+            if None in columns:
+                continue
+
+            if len(columns) == 1:
+                values = columns[0]
+            else:
+                values = map(operator.sub, columns[0], columns[1])
+
+            output = self.store.columns.get(rule.name)
+            if output is None:
+                output = self.store.addColumn(rule.name)
+            changedAt = self.changedAt[rule.name]
+            if len(changedAt) < len(output):
+                changedAt.extend([-math.inf] * (len(output) - len(changedAt)))
+            listeners = self.listeners[rule.name]
+
+            for slot, value in zip(range(len(output)), values):
+                if value != value:
+                    # Unknown input
+                    continue
+
+                current = output[slot]
+                if current == 1.0:
+                    active = value >= rule.offBelow
+                else:
+                    active = value > rule.onAbove
+
+                # An unknown output (NaN) never compares equal, so it is set
+                if active == current:
+                    continue
+                if now - changedAt[slot] < rule.minHold:
+                    continue
+
+                output[slot] = float(active)
+                # The first known value does not start the hold
+                if current == current:
+                    changedAt[slot] = now
+                listener = listeners.get(slot)
+                if listener:
+                    try:
+                        listener(active)
+                    except Exception:
+                        logger.error(f"Error applying {rule.name}", exc_info=True)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.evaluate()
+            except Exception:
+                logger.error("Error evaluating the derived state", exc_info=True)
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name="homekit-derived-state", daemon=True
+        )
+        self.thread.start()
+
+
+derivedState = DerivedStateEngine(stateStore)
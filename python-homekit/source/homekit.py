@@ -9,7 +9,13 @@ import paho.mqtt.client as mqtt
 from docker_secrets import getDocketSecrets
 
 import iotcloud_api
-import accessories
+import aid_index
+import bridge_setup
+import commands
+import derived_state
+import ingest
+import profiler
+import transport
 
 # Logging setup
 logger = logging.getLogger()
@@ -25,6 +31,9 @@ logger.addHandler(handler)
 
 logger.info("Starting...")
 
+# Sampling profiler, idle until requested
+profiler.setupProfiler("../logs")
+
 locationId = getDocketSecrets("locationId")
 
 # IotHub api setup
@@ -35,26 +44,57 @@ driver = AccessoryDriver(port=51826, persist_file="/homekit_data/iotcloud.state"
 bridge = Bridge(driver, "IotCloud")
 
 # Setup MQTT client
-mqttclient = mqtt.Client(client_id="homekit", userdata=bridge, transport="websockets")
 token = getDocketSecrets("mqtt_token")
-mqttclient.username_pw_set(token, "_")
-mqttclient.tls_set(
-    ca_certs=None,
-    certfile=None,
-    keyfile=None,
-    cert_reqs=ssl.CERT_REQUIRED,
-    tls_version=ssl.PROTOCOL_TLSv1_2,
-)
+
+
+def createMqttClient(endpoint):
+    client = mqtt.Client(
+        client_id="homekit", userdata=bridge, transport=endpoint.transport
+    )
+    client.username_pw_set(token, "_")
+    if endpoint.tls:
+        client.tls_set(
+            ca_certs=endpoint.caCerts,
+            certfile=None,
+            keyfile=None,
+            cert_reqs=ssl.CERT_REQUIRED,
+            tls_version=ssl.PROTOCOL_TLSv1_2,
+        )
+    return client
+
+
+# Brokers by priority, the LAN ones first. Defaults to the cloud broker
+try:
+    endpoints = [
+        transport.Endpoint.fromDict(endpoint)
+        for endpoint in getDocketSecrets("mqtt_endpoints")
+    ]
+except KeyError:
+    endpoints = [transport.CLOUD_ENDPOINT]
+
+mqttclient = transport.TransportSelector(endpoints, createMqttClient)
+
+
+def onInventoryChanged():
+    # The accessories are only built on startup, so stop and let
+    # run_homekit.sh start the bridge again. The driver only bumps the
+    # configuration number if the accessory database it serves changed
+    logger.info("Restarting to rebuild the accessories")
+    driver.stop()
+
+
+# Checks the devices out of the paho thread, once a burst of updates settles
+inventoryWatcher = bridge_setup.InventoryWatcher(api, onInventoryChanged)
 
 
 def onSensorUpdated(client, bridge, msg):
     logger.info("Sensor updated")
-    bridge.driver.config_changed()
+    inventoryWatcher.request()
 
 
 def onLocationUpdated(client, bridge, msg):
     logger.info("Location updated")
-    bridge.driver.config_changed()
+    inventoryWatcher.request()
 
 
 def onConnect(self, bridge, flags, rc):
@@ -64,10 +104,13 @@ def onConnect(self, bridge, flags, rc):
     topicHeader = f"v1/{locationId}/+/"
     sensorUpdateTopic = topicHeader + "+/updatedSensor"
     locationUpdatedTopic = f"v1/{locationId}/updatedLocation"
+    # Batched payloads of every sensor, dispatched by the accessory callbacks
+    batchTopic = topicHeader + "+/batch"
 
     # Setup subscriptions
     mqttclient.subscribe(locationUpdatedTopic)
     mqttclient.subscribe(sensorUpdateTopic)
+    mqttclient.subscribe(batchTopic)
     mqttclient.message_callback_add(locationUpdatedTopic, onLocationUpdated)
     mqttclient.message_callback_add(sensorUpdateTopic, onSensorUpdated)
 
@@ -78,62 +121,46 @@ def onConnect(self, bridge, flags, rc):
 
 mqttclient.on_connect = onConnect
 
+# Commands to the devices go through the outbound scheduler
+try:
+    inflightWindow = int(getDocketSecrets("mqtt_inflight_window"))
+except KeyError:
+    inflightWindow = commands.DEFAULT_INFLIGHT_WINDOW
+try:
+    deviceWindow = int(getDocketSecrets("mqtt_device_window"))
+except KeyError:
+    deviceWindow = commands.DEFAULT_DEVICE_WINDOW
+commandScheduler = commands.CommandScheduler(mqttclient, inflightWindow, deviceWindow)
+
+# In flight commands are lost with the previous connection, and the message
+# ids start again with every client
+mqttclient.onClientChanged = commandScheduler.setClient
+
 # Connect
-mqttclient.connect("mqtt.iotcloud.es", 443, 30)
-mqttclient.loop_start()
-
-
-def setupBridge(bridge, driver):
-    devices = api.getDevices()
-    for device in devices:
-        deviceId = device["deviceId"]
-        for sensor in device["sensors"]:
-            sensorName = sensor["sensorName"]
-            sensorType = sensor["sensorType"]
-            sensorId = sensor["sensorId"]
-            logger.info(sensorId)
-            topic = f"v1/{locationId}/{deviceId}/{sensorId}/"
-
-            if sensorType == "analog":
-                if sensorId.endswith("T"):
-                    acc = accessories.TempSensor(
-                        driver, sensorName, sensorId, mqttclient, topic
-                    )
-                elif sensorId.endswith("H"):
-                    acc = accessories.HumSensor(
-                        driver, sensorName, sensorId, mqttclient, topic
-                    )
-                elif sensorId.endswith("CO2"):
-                    acc = accessories.CO2Sensor(
-                        driver, sensorName, sensorId, mqttclient, topic
-                    )
-                else:
-                    logger.error(f"Analog sensor {sensorId} not supported")
-                    continue
-
-            elif sensorType == "switch":
-                acc = accessories.Switch(
-                    driver, sensorName, sensorId, mqttclient, topic
-                )
-            elif sensorType == "led":
-                acc = accessories.LedLight(
-                    driver, sensorName, sensorId, mqttclient, topic
-                )
-            elif sensorType == "ledRGB":
-                acc = accessories.RGBLight(
-                    driver, sensorName, sensorId, mqttclient, topic
-                )
-            elif sensorType == "thermostat":
-                acc = accessories.Thermostat(
-                    driver, sensorName, sensorId, mqttclient, topic
-                )
-            else:
-                logger.error(f"Sensor type {sensorType} not supported")
-                continue
-
-            bridge.add_accessory(acc)
-
-
-setupBridge(bridge, driver)
+mqttclient.start()
+
+
+# Sensor updates are handled out of the paho thread, through a bounded buffer
+ingestBuffer = ingest.IngestBuffer()
+ingestBuffer.start()
+bufferedClient = ingest.BufferedClient(commandScheduler, ingestBuffer)
+
+# Accessory ids are kept across restarts and inventory changes
+aidIndex = aid_index.AidIndex("/homekit_data/aids.json")
+
+inventoryWatcher.signature = bridge_setup.setupBridge(
+    bridge, driver, api, bufferedClient, locationId, aidIndex
+)
+inventoryWatcher.start()
+
+# Alarms and other signals derived from the latest values, with hysteresis
+try:
+    derived_state.derivedState.setRules(
+        derived_state.loadRules(getDocketSecrets("derived_rules"))
+    )
+except KeyError:
+    pass
+derived_state.derivedState.start()
+
 driver.add_accessory(accessory=bridge)
 driver.start()
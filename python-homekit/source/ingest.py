@@ -0,0 +1,169 @@
+import collections
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger()
+
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_BLOCK_TIMEOUT = 5.0
+BACKLOG_LOG_INTERVAL = 60.0
+STATS_LOG_INTERVAL = 300.0
+
+
+def isStateTopic(topic):
+    """Value and state topics only matter for their latest payload"""
+
+    lastLevel = topic.rsplit("/", 1)[-1]
+    return lastLevel in ("value", "state") or "/aux/" in topic
+
+
+class IngestBuffer:
+    """Bounded buffer between the paho network thread and the message handlers
+
+    Messages on coalesced topics replace any unprocessed message of the
+    same topic for the same subscription, so only the latest value is
+    handled. The replacement goes to the back of the queue, so it is never
+    applied before a message received ahead of it, such as a batch for the
+    same sensor. The rest of the messages are
+    queued in strict order. When the buffer is full the paho thread is
+    blocked, up to `blockTimeout` seconds, which stops reading from the
+    broker; after that the message is dropped.
+    """
+
+    def __init__(self, maxSize=DEFAULT_MAX_SIZE, blockTimeout=DEFAULT_BLOCK_TIMEOUT):
+        self.maxSize = maxSize
+        self.blockTimeout = blockTimeout
+        self.pending = collections.OrderedDict()
+        self.condition = threading.Condition()
+        self.sequence = itertools.count()
+        self.thread = None
+        self.running = False
+
+        # Metrics
+        self.received = 0
+        self.processed = 0
+        self.superseded = 0
+        self.overflowed = 0
+        self.maxDepth = 0
+        self.blockedTime = 0.0
+        self.lastBacklogLog = 0.0
+        self.lastStatsLog = time.monotonic()
+
+    def put(self, sub, topic, callback, args, coalesce=True):
+        with self.condition:
+            self.received += 1
+            key = (sub, topic)
+            if coalesce and key in self.pending:
+                self.pending[key] = (callback, args)
+                self.pending.move_to_end(key)
+                self.superseded += 1
+                return True
+
+            if len(self.pending) >= self.maxSize:
+                start = time.monotonic()
+                notFull = self.condition.wait_for(
+                    lambda: len(self.pending) < self.maxSize, self.blockTimeout
+                )
+                self.blockedTime += time.monotonic() - start
+                if not notFull:
+                    self.overflowed += 1
+                    logger.warning(f"Ingest buffer full, message on {topic} dropped")
+                    return False
+
+            if not coalesce:
+                key = (sub, topic, next(self.sequence))
+            self.pending[key] = (callback, args)
+            self.maxDepth = max(self.maxDepth, len(self.pending))
+            self.condition.notify_all()
+            return True
+
+    def get(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending or not self.running)
+            if not self.pending:
+                return None
+            _, item = self.pending.popitem(last=False)
+            depth = len(self.pending)
+            self.condition.notify_all()
+
+        if depth > self.maxSize // 2:
+            now = time.monotonic()
+            if now - self.lastBacklogLog > BACKLOG_LOG_INTERVAL:
+                self.lastBacklogLog = now
+                logger.warning(f"Ingest buffer backed up: {self.stats()}")
+        return item
+
+    def run(self):
+        while True:
+            item = self.get()
+            if item is None:
+                return
+
+            callback, args = item
+            try:
+                callback(*args)
+            except Exception:
+                logger.error("Error handling a message", exc_info=True)
+            self.processed += 1
+            self.logStats()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(
+            target=self.run, name="homekit-ingest", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread:
+            self.thread.join()
+
+    def logStats(self):
+        now = time.monotonic()
+        if now - self.lastStatsLog < STATS_LOG_INTERVAL:
+            return
+        self.lastStatsLog = now
+        logger.info(f"Ingest buffer: {self.stats()}")
+
+    def stats(self):
+        return {
+            "depth": len(self.pending),
+            "maxDepth": self.maxDepth,
+            "received": self.received,
+            "processed": self.processed,
+            "superseded": self.superseded,
+            "overflowed": self.overflowed,
+            "blockedSeconds": self.blockedTime,
+        }
+
+
+class BufferedClient:
+    """MQTT client wrapper that routes the message callbacks through an IngestBuffer
+
+    Everything else is forwarded to the wrapped client.
+    """
+
+    def __init__(self, mqttclient, ingestBuffer, coalesce=isStateTopic):
+        self.mqttclient = mqttclient
+        self.ingestBuffer = ingestBuffer
+        self.coalesce = coalesce
+
+    def message_callback_add(self, sub, callback):
+        def onMessage(client, userdata, msg):
+            self.ingestBuffer.put(
+                sub,
+                msg.topic,
+                callback,
+                (client, userdata, msg),
+                self.coalesce(msg.topic),
+            )
+
+        self.mqttclient.message_callback_add(sub, onMessage)
+
+    def __getattr__(self, name):
+        return getattr(self.mqttclient, name)
@@ -0,0 +1,114 @@
+import collections
+import datetime
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+logger = logging.getLogger()
+
+# Environment variables controlling the profiler
+PROFILE_ENV = "HOMEKIT_PROFILE"
+DURATION_ENV = "HOMEKIT_PROFILE_DURATION"
+INTERVAL_ENV = "HOMEKIT_PROFILE_INTERVAL"
+
+DEFAULT_DURATION = 30.0
+DEFAULT_INTERVAL = 0.01
+
+
+class SamplingProfiler:
+    """Samples the stacks of every thread of the process
+
+    Nothing runs until a profile is started: a background thread then takes
+    a sample every `interval` seconds during `duration` seconds (covering the
+    paho network thread and the thread running the HAP asyncio loop) and
+    dumps them in the collapsed stack format used by flamegraph.pl and
+    speedscope.
+    """
+
+    def __init__(self, outputDir, interval=DEFAULT_INTERVAL):
+        self.outputDir = outputDir
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self, duration=DEFAULT_DURATION):
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                logger.warning("A profile is already running")
+                return False
+
+            self.thread = threading.Thread(
+                target=self.run, args=(duration,), name="homekit-profiler", daemon=True
+            )
+            self.thread.start()
+            return True
+
+    def run(self, duration):
+        logger.info(f"Profiling for {duration} seconds")
+        stacks = collections.Counter()
+        numSamples = 0
+        ownId = threading.get_ident()
+        endTime = time.monotonic() + duration
+        while time.monotonic() < endTime:
+            threadNames = {t.ident: t.name for t in threading.enumerate()}
+            for threadId, frame in sys._current_frames().items():
+                if threadId == ownId:
+                    continue
+                stacks[self.collapse(threadNames.get(threadId, threadId), frame)] += 1
+            numSamples += 1
+            time.sleep(self.interval)
+
+        outputPath = self.dump(stacks)
+        logger.info(f"Profile with {numSamples} samples stored in {outputPath}")
+
+    @staticmethod
+    def collapse(threadName, frame):
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            fileName = os.path.basename(code.co_filename)
+            frames.append(f"{code.co_name} ({fileName}:{frame.f_lineno})")
+            frame = frame.f_back
+        frames.append(str(threadName))
+        # Root first, and without the separator used by the format
+        return ";".join(name.replace(";", ":") for name in reversed(frames))
+
+    def dump(self, stacks):
+        os.makedirs(self.outputDir, exist_ok=True)
+        fileName = f"profile-{datetime.datetime.now():%Y%m%dT%H%M%S}.folded"
+        outputPath = os.path.join(self.outputDir, fileName)
+        with open(outputPath, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return outputPath
+
+
+def setupProfiler(outputDir):
+    """Install the profiling triggers
+
+    A profile is taken at startup when HOMEKIT_PROFILE is set, and every
+    time the process receives SIGUSR1.
+    """
+
+    try:
+        duration = float(os.environ.get(DURATION_ENV, DEFAULT_DURATION))
+        interval = float(os.environ.get(INTERVAL_ENV, DEFAULT_INTERVAL))
+    except ValueError:
+        logger.error("The profiler settings are not valid, using the defaults")
+        duration = DEFAULT_DURATION
+        interval = DEFAULT_INTERVAL
+
+    profiler = SamplingProfiler(outputDir, interval)
+
+    def onSignal(signum, frame):
+        profiler.start(duration)
+
+    signal.signal(signal.SIGUSR1, onSignal)
+
+    if os.environ.get(PROFILE_ENV, "").lower() in ["1", "true"]:
+        profiler.start(duration)
+
+    return profiler
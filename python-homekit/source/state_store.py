@@ -0,0 +1,78 @@
+import array
+import math
+import threading
+
+UNKNOWN = math.nan
+
+
+class StateStore:
+    """Latest characteristic values of every accessory, in columns
+
+    Each accessory gets a slot when it is registered and every
+    characteristic name has an array of doubles indexed by slot, NaN while
+    unknown. Writes are a single array store and a snapshot copies whole
+    arrays, so the state of the bridge can be read without walking the
+    accessories.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.slots = {}  # aid: slot
+        self.aids = array.array("Q")
+        self.columns = {}  # characteristic name: array of values by slot
+
+    def register(self, aid):
+        with self.lock:
+            try:
+                return self.slots[aid]
+            except KeyError:
+                pass
+
+            slot = len(self.aids)
+            self.slots[aid] = slot
+            self.aids.append(aid)
+            for column in self.columns.values():
+                column.append(UNKNOWN)
+            return slot
+
+    def addColumn(self, name):
+        with self.lock:
+            if name not in self.columns:
+                self.columns[name] = array.array("d", [UNKNOWN]) * len(self.aids)
+            return self.columns[name]
+
+    def write(self, slot, name, value):
+        try:
+            column = self.columns[name]
+        except KeyError:
+            column = self.addColumn(name)
+        column[slot] = value
+
+    def read(self, slot, name, default=None):
+        try:
+            value = self.columns[name][slot]
+        except KeyError:
+            return default
+        return default if math.isnan(value) else value
+
+    def snapshot(self):
+        """Return a copy of the aids and of every column"""
+
+        with self.lock:
+            return self.aids[:], {
+                name: column[:] for name, column in self.columns.items()
+            }
+
+    def export(self):
+        """Return the known values by aid and characteristic name"""
+
+        aids, columns = self.snapshot()
+        state = {aid: {} for aid in aids}
+        for name, column in columns.items():
+            for aid, value in zip(aids, column):
+                if not math.isnan(value):
+                    state[aid][name] = value
+        return state
+
+
+stateStore = StateStore()
@@ -0,0 +1,268 @@
+import logging
+import socket
+import threading
+import time
+
+logger = logging.getLogger()
+
+DEFAULT_KEEPALIVE = 30
+DEFAULT_CHECK_INTERVAL = 30.0
+DEFAULT_FAILOVER_TIMEOUT = 60.0
+PROBE_TIMEOUT = 3.0
+CONNACK_TIMEOUT = 10.0
+REJECTED_RETRY_DELAY = 600.0
+
+
+class Endpoint:
+    def __init__(
+        self, host, port, transport="tcp", tls=False, caCerts=None, keepalive=None
+    ):
+        self.host = host
+        self.port = port
+        self.transport = transport
+        self.tls = tls
+        self.caCerts = caCerts
+        self.keepalive = keepalive or DEFAULT_KEEPALIVE
+
+    @classmethod
+    def fromDict(cls, data):
+        return cls(
+            data["host"],
+            int(data["port"]),
+            transport=data.get("transport", "tcp"),
+            tls=data.get("tls", False),
+            caCerts=data.get("caCerts"),
+            keepalive=data.get("keepalive"),
+        )
+
+    def __str__(self):
+        scheme = {"tcp": "mqtt", "websockets": "ws"}[self.transport]
+        return f"{scheme}{'s' if self.tls else ''}://{self.host}:{self.port}"
+
+
+CLOUD_ENDPOINT = Endpoint("mqtt.iotcloud.es", 443, transport="websockets", tls=True)
+
+
+def isReachable(endpoint, timeout=PROBE_TIMEOUT):
+    try:
+        with socket.create_connection((endpoint.host, endpoint.port), timeout):
+            return True
+    except OSError:
+        return False
+
+
+class TransportSelector:
+    """Keeps the MQTT connection on the best available endpoint
+
+    The endpoints are given in priority order, typically a broker on the
+    LAN first and the cloud broker as fallback. A new paho client is built by
+    `clientFactory` for every connection and gets the message callbacks and
+    settings registered on the selector, so the topic scheme and the handlers
+    do not change with the endpoint. Starting from a new client also avoids
+    replaying stale commands queued on the previous connection.
+
+    A health check thread fails over when the active client has been
+    disconnected for `failoverTimeout` seconds, and goes back to a
+    preferred endpoint as soon as it is reachable again. A switch only
+    happens once the new broker has accepted the connection; until then the
+    previous client is kept, and an endpoint that refuses it (bad token,
+    ACL) is not tried again for `REJECTED_RETRY_DELAY` seconds.
+    `onClientChanged` is called with every new paho client before it
+    becomes active and its on_connect runs, and `onEndpointChanged` with the
+    new endpoint after every switch.
+    """
+
+    def __init__(
+        self,
+        endpoints,
+        clientFactory,
+        checkInterval=DEFAULT_CHECK_INTERVAL,
+        failoverTimeout=DEFAULT_FAILOVER_TIMEOUT,
+    ):
+        self.endpoints = endpoints
+        self.clientFactory = clientFactory
+        self.checkInterval = checkInterval
+        self.failoverTimeout = failoverTimeout
+        self.lock = threading.RLock()
+        self.client = None
+        self.active = 0
+        self.disconnectedSince = None
+        self.onClientChanged = None
+        self.onEndpointChanged = None
+        self.thread = None
+        self.rejectedUntil = {}  # endpoint index: monotonic time
+
+        # Client waiting for its CONNACK and the on_connect arguments received
+        self.connecting = None
+        self.connectArgs = None
+        self.connectEvent = threading.Event()
+
+        # Applied to every new client
+        self.callbacks = {}
+        self.settings = {}
+        self.maxInflight = None
+
+    @property
+    def endpoint(self):
+        return self.endpoints[self.active]
+
+    def newClient(self, endpoint):
+        client = self.clientFactory(endpoint)
+        for name, value in list(self.settings.items()):
+            setattr(client, name, value)
+        client.on_connect = self.onClientConnect
+        for sub, callback in list(self.callbacks.items()):
+            client.message_callback_add(sub, callback)
+        if self.maxInflight is not None:
+            client.max_inflight_messages_set(self.maxInflight)
+        return client
+
+    def connectTo(self, index):
+        """Connect a new client to an endpoint and make it the active one
+
+        Returns False, leaving the active client untouched, unless the broker
+        accepts the connection within `CONNACK_TIMEOUT` seconds.
+        """
+
+        endpoint = self.endpoints[index]
+        client = self.newClient(endpoint)
+        self.connecting = client
+        self.connectEvent.clear()
+        try:
+            client.connect(endpoint.host, endpoint.port, endpoint.keepalive)
+        except (OSError, ValueError) as e:
+            self.connecting = None
+            logger.warning(f"Unable to connect to {endpoint}: {e}")
+            return False
+
+        client.loop_start()
+        accepted = self.connectEvent.wait(CONNACK_TIMEOUT)
+        self.connecting = None
+        rc = self.connectArgs[3] if accepted else None
+        if rc != 0:
+            client.disconnect()
+            client.loop_stop()
+            self.rejectedUntil[index] = time.monotonic() + REJECTED_RETRY_DELAY
+            logger.warning(f"{endpoint} did not accept the connection: {rc}")
+            return False
+
+        self.activate(index, client)
+        logger.info(f"Using the MQTT endpoint {endpoint}")
+        # Delayed until the client is active, so it gets the subscriptions
+        callback = self.settings.get("on_connect")
+        if callback:
+            callback(*self.connectArgs)
+        return True
+
+    def connectAsync(self, index):
+        """Let paho keep retrying the endpoint in the background"""
+
+        endpoint = self.endpoints[index]
+        self.activate(index, self.newClient(endpoint))
+        self.client.connect_async(endpoint.host, endpoint.port, endpoint.keepalive)
+        self.client.loop_start()
+
+    def activate(self, index, client):
+        if self.onClientChanged:
+            self.onClientChanged(client)
+        self.active = index
+        self.client = client
+
+    def start(self):
+        with self.lock:
+            for index in range(len(self.endpoints)):
+                if self.connectTo(index):
+                    break
+            else:
+                self.connectAsync(0)
+
+        self.thread = threading.Thread(
+            target=self.run, name="homekit-transport", daemon=True
+        )
+        self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.checkInterval)
+            try:
+                self.check()
+            except Exception:
+                logger.error("Error checking the MQTT endpoints", exc_info=True)
+
+    def check(self):
+        with self.lock:
+            if self.client.is_connected():
+                self.disconnectedSince = None
+                candidates = range(self.active)
+            else:
+                now = time.monotonic()
+                if self.disconnectedSince is None:
+                    self.disconnectedSince = now
+                if now - self.disconnectedSince < self.failoverTimeout:
+                    return
+                candidates = [i for i in range(len(self.endpoints)) if i != self.active]
+
+            now = time.monotonic()
+            candidates = [i for i in candidates if self.rejectedUntil.get(i, 0) <= now]
+            for index in candidates:
+                if isReachable(self.endpoints[index]) and self.switchTo(index):
+                    return
+
+    def switchTo(self, index):
+        previous = self.client
+        logger.info(f"Switching from {self.endpoint} to {self.endpoints[index]}")
+        if not self.connectTo(index):
+            # Still on the previous client, connected or retrying
+            return False
+
+        previous.disconnect()
+        previous.loop_stop()
+        self.disconnectedSince = None
+        if self.onEndpointChanged:
+            self.onEndpointChanged(self.endpoint)
+        return True
+
+    # Paho client interface. These are also called from the paho threads, so
+    # they do not take the lock held while switching, which joins them
+
+    def onClientConnect(self, client, userdata, *args):
+        if client is self.connecting:
+            # connectTo decides if the connection is kept
+            self.connectArgs = (client, userdata, *args)
+            self.connectEvent.set()
+            return
+
+        callback = self.settings.get("on_connect")
+        if callback:
+            callback(client, userdata, *args)
+
+    def message_callback_add(self, sub, callback):
+        self.callbacks[sub] = callback
+        if self.client:
+            self.client.message_callback_add(sub, callback)
+
+    def message_callback_remove(self, sub):
+        self.callbacks.pop(sub, None)
+        if self.client:
+            self.client.message_callback_remove(sub)
+
+    def max_inflight_messages_set(self, inflight):
+        self.maxInflight = inflight
+        if self.client:
+            self.client.max_inflight_messages_set(inflight)
+
+    def __setattr__(self, name, value):
+        # Paho callbacks (on_connect, on_publish...) are kept for the next clients
+        if name.startswith("on_"):
+            self.settings[name] = value
+            # on_connect is called through onClientConnect
+            if self.client and name != "on_connect":
+                setattr(self.client, name, value)
+            return
+        super().__setattr__(name, value)
+
+    def __getattr__(self, name):
+        # subscribe, publish and the rest go to the active client
+        if name.startswith("on_"):
+            return self.settings.get(name)
+        return getattr(self.client, name)
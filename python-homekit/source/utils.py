@@ -9,13 +9,6 @@ import hashlib
 logger = logging.getLogger()
 
 
-def decodeBoolean(value):
-    value = value.decode()
-    assert value.lower() in ["true", "false"]
-    state = value.lower() == "true"
-    return state
-
-
 def decodeStatus(value):
     value = value.decode()
     assert value.lower() in ["online", "offline"]